@@ -1,8 +1,8 @@
-import copy
 import os.path
+import re
 import sys
-
-from openpyxl import load_workbook
+import tempfile
+from xml.etree import ElementTree
 
 drvUser2DTYP = {
     'BCD': 'asynInt32',
@@ -17,9 +17,17 @@ drvUser2DTYP = {
     'STRING': 'asynInt32',
     'ZSTRING': 'asynInt32',
 }
+# DTYP field lines are shared by every record of the same data type.
+drvUser2DTYPLine = {key: f'\tfield(DTYP, "{value}")\n' for key, value in drvUser2DTYP.items()}
+
+
+class ConfigError(Exception):
+    pass
 
 
 class ModbusDevice:
+    __slots__ = ('name', 'device_type', 'address', 'info')
+
     def __init__(self):
         self.name = None
         self.device_type = None
@@ -34,6 +42,12 @@ DeviceRegistered = {}
 
 
 class ModbusRecord:
+    __slots__ = ('name', 'name_prefix', 'name_seperator', 'type', 'scan', 'desc', 'prec', 'egu', 'other_fields',
+                 'device', 'memory_address', 'memory_length', 'device_access', 'drvUser_prefix', 'drvUser_suffix',
+                 'modbus_funcode', 'interface_name', 'memory_address_mask', '_record_name', '_prepared')
+    # fields which may be given as keyword arguments
+    field_names = frozenset(name for name in __slots__ if not name.startswith('_'))
+
     def __init__(self, record_name, record_type, record_scan='Passive', **kwargs):
         self.name = record_name
         self.name_prefix = None
@@ -54,30 +68,39 @@ class ModbusRecord:
         self.modbus_funcode = None  # 3, 16
         self.interface_name = None
         self.memory_address_mask = None
+        self._record_name = None  # name_prefix, name_seperator and name, derived in gen_prepare
+        self._prepared = False
 
         for key, value in kwargs.items():
-            if hasattr(self, key):
+            if key in self.field_names:
                 setattr(self, key, value)
 
-    def __str__(self):
-        self.gen_prepare()
-        res = ''
-        for line in self.gen_config_lines():
-            res += line
-        for line in self.gen_db_lines():
-            res += line
-        return res
+    # shallow copy, the device is shared and other_fields gets a list of its own.
+    def clone(self):
+        record = ModbusRecord.__new__(ModbusRecord)
+        for attr in self.__slots__:
+            setattr(record, attr, getattr(self, attr))
+        record.other_fields = list(self.other_fields)
+        # the clone is usually changed afterwards, derive its fields again.
+        record._prepared = False
+        return record
 
-    @staticmethod
-    def get_field_line(field_str):
-        return f'field({field_str})'
+    def __str__(self):
+        lines = [self.gen_config_lines()]
+        lines.extend(self.gen_db_lines())
+        return ''.join(lines)
 
+    # check and derive the generated fields once, the given fields are kept so preparing again is safe.
     def gen_prepare(self):
+        if self._prepared:
+            return
+        self.gen_check()
+        self._prepared = True
         #
         if not self.name_prefix:
-            self.name_prefix = ''
+            self._record_name = self.name
         else:
-            self.name_prefix = self.name_prefix + self.name_seperator
+            self._record_name = self.name_prefix + self.name_seperator + self.name
         #
         if not self.drvUser_suffix:
             self.drvUser_suffix = ''
@@ -96,6 +119,23 @@ class ModbusRecord:
             self.modbus_funcode = 16
             self.interface_name = self.name + f"{self.modbus_funcode}W"
 
+    # raise ConfigError for settings the gen_*_lines can not handle, called by gen_prepare.
+    def gen_check(self):
+        # gen_prepare joins the name fields, they have to be text.
+        if not isinstance(self.name, str):
+            raise ConfigError(f'ModbusRecord.gen_check failed, no PV name is given for the record '
+                              f'at address {self.memory_address}.')
+        for attr in ('name_prefix', 'drvUser_suffix'):
+            value = getattr(self, attr)
+            if value and not isinstance(value, str):
+                raise ConfigError(f'{self.name}.gen_check failed, {attr} {value!r} is not text.')
+        if self.device is None:
+            raise ConfigError(f'{self.name}.gen_check failed, no device is given.')
+        if self.drvUser_prefix not in drvUser2DTYPLine:
+            raise ConfigError(f'{self.name}.gen_check failed, unknown drvUser "{self.drvUser_prefix}".')
+        if self.device_access not in ('r', 'w'):
+            raise ConfigError(f'{self.name}.gen_check failed, unknown device access "{self.device_access}".')
+
     def gen_config_lines(self):
         # drvModbusAsynConfigure(portName,
         #                        tcpPortName,
@@ -106,152 +146,234 @@ class ModbusRecord:
         #                        dataType,
         #                        pollMsec,
         #                        plcType);
+        self.gen_prepare()
+        device_name = self.device.name
         return (f'drvModbusAsynConfigure('
                 f'"{self.interface_name}", '
-                f'"{self.device.name}", '
+                f'"{device_name}", '
                 f'0, '
                 f'{self.modbus_funcode}, '
                 f'{self.memory_address}, '
                 f'{self.memory_length}, '
                 f'0, '
                 f'100, '
-                f'"{self.device.name}")\n')
+                f'"{device_name}")\n')
 
     def gen_db_lines(self):
+        self.gen_prepare()
+        record_name = self._record_name
+        drv_user = self.drvUser_prefix + self.drvUser_suffix
         db_lines = [
-            f'record({self.type}, "{self.name_prefix + self.name}"){{\n',
+            f'record({self.type}, "{record_name}"){{\n',
         ]
+        add = db_lines.append
         # DTYP
-        line = self.get_field_line(f'DTYP, "{drvUser2DTYP[self.drvUser_prefix]}"')
-        db_lines.append(f'\t{line}\n')
-        # INP or OUT
+        add(drvUser2DTYPLine[self.drvUser_prefix])
+        # INP or OUT, gen_check only lets device access 'r' and 'w' through.
         if self.device_access == 'r' and 'a' in self.type:
-            line = self.get_field_line(
-                f'INP, "@asyn({self.interface_name} 0){self.drvUser_prefix + self.drvUser_suffix}"')
-        elif self.device_access == 'r' and 'b' in self.type:
-            line = self.get_field_line(
-                f'INP, "@asynMask({self.interface_name} 0 {self.memory_address_mask}){self.drvUser_prefix + self.drvUser_suffix}"')
-        elif self.device_access == 'w' and 'a' in self.type:
-            line = self.get_field_line(
-                f'OUT, "@asyn({self.interface_name} 0){self.drvUser_prefix + self.drvUser_suffix}"')
-        elif self.device_access == 'w' and 'b' in self.type:
-            line = self.get_field_line(
-                f'OUT, "@asynMask({self.interface_name} 0 {self.memory_address_mask}){self.drvUser_prefix + self.drvUser_suffix}"')
+            add(f'\tfield(INP, "@asyn({self.interface_name} 0){drv_user}")\n')
+        elif self.device_access == 'r':
+            add(f'\tfield(INP, "@asynMask({self.interface_name} 0 {self.memory_address_mask}){drv_user}")\n')
+        elif 'a' in self.type:
+            add(f'\tfield(OUT, "@asyn({self.interface_name} 0){drv_user}")\n')
         else:
-            print(f'{self.name}.gen_db_lines failed for line "INP" or "OUT". {self.device_access} {self.type}')
-        db_lines.append(f'\t{line}\n')
+            add(f'\tfield(OUT, "@asynMask({self.interface_name} 0 {self.memory_address_mask}){drv_user}")\n')
         # SCAN
         if self.scan:
-            line = self.get_field_line(f'SCAN, "{self.scan}"')
-            db_lines.append(f'\t{line}\n')
+            add(f'\tfield(SCAN, "{self.scan}")\n')
         # DESC
         if self.desc:
-            line = self.get_field_line(f'DESC, "{self.desc}"')
-            db_lines.append(f'\t{line}\n')
+            add(f'\tfield(DESC, "{self.desc}")\n')
         # PREC
         if self.prec:
-            line = self.get_field_line(f'PREC, "{self.prec}"')
-            db_lines.append(f'\t{line}\n')
+            add(f'\tfield(PREC, "{self.prec}")\n')
         # EGU
         if self.egu:
-            line = self.get_field_line(f'EGU, "{self.egu}"')
-            db_lines.append(f'\t{line}\n')
+            add(f'\tfield(EGU, "{self.egu}")\n')
         # other other_fields
         if self.other_fields:
             for item in self.other_fields:
                 if item:
-                    line = self.get_field_line(item)
-                    db_lines.append(f'\t{line}\n')
+                    add(f'\tfield({item})\n')
         # end
-        db_lines.append(f'}}\n')
+        add('}\n')
         return db_lines
 
 
-# return a list of EXCEL contents, merged_cells are handled.
+# check for a token in the raw bytes of a source, much cheaper than parsing its xml.
+def _source_contains(source, token):
+    tail = b''
+    for chunk in iter(lambda: source.read(1 << 20), b''):
+        if token in tail + chunk[:len(token)] or token in chunk:
+            return True
+        tail = chunk[1 - len(token):]
+    return False
+
+
+# return the bounds (min_row, min_col, max_row, max_col) of the merged cells of a read-only sheet.
+# read-only sheets have no merged_cells, so read the <mergeCell ref="..."> elements from the sheet xml
+# instead of loading the whole workbook for them.
+def get_merged_cells(sheet):
+    from openpyxl.utils import range_boundaries
+
+    # sheets without merged cells are not parsed here, only by the streaming pass.
+    merged_cells = []
+    with sheet._get_source() as f:
+        if not _source_contains(f, b'mergeCell'):
+            return merged_cells
+    with sheet._get_source() as f:
+        for _, element in ElementTree.iterparse(f):
+            if element.tag.rsplit('}', 1)[-1] == 'mergeCell':
+                min_col, min_row, max_col, max_row = range_boundaries(element.get('ref'))
+                if (min_row, min_col) != (max_row, max_col):
+                    merged_cells.append((min_row, min_col, max_row, max_col))
+            # drop the parsed cells, memory stays flat over the sheet data.
+            element.clear()
+    return merged_cells
+
+
+# yield the rows of EXCEL contents, merged_cells are handled and empty rows are skipped.
 def get_excel_cells(file_path='./modbus2db.xlsx', sheet_name='example'):
-    workbook = load_workbook(file_path)
-    sheet_loaded = workbook[sheet_name]
-    # print(sheet_loaded.calculate_dimension())
-
-    excel_list = []
-    for row in sheet_loaded.iter_rows():
-        line_list = []
-        for cell in row:
-            line_list.append(cell.value)
-        else:
-            excel_list.append(line_list)
+    # openpyxl is only needed here, keep its heavy import out of module import time.
+    from openpyxl import load_workbook
+
+    # read cell values in read-only mode, which streams rows instead of building the whole sheet.
+    workbook = load_workbook(file_path, read_only=True, data_only=True, keep_links=False, keep_vba=False)
+    try:
+        sheet_loaded = workbook[sheet_name]
+        # some writers store a bogus "A1:A1" dimension, let openpyxl scan the sheet instead.
+        if sheet_loaded.max_row == 1 and sheet_loaded.max_column == 1:
+            sheet_loaded.reset_dimensions()
+
+        # merged cells are not available in read-only mode, their bounds come from the sheet xml.
+        merged_cells = get_merged_cells(sheet_loaded)
+        # merged ranges by their first row, the value of a range is known once that row has been read.
+        # sheets without merged cells skip the merged handling while reading.
+        merged_starts = {}
+        for min_row, min_col, max_row, max_col in merged_cells:
+            merged_starts.setdefault(min_row - 1, []).append((min_col - 1, max_row, max_col))
+        # (first column, end column, value) of the merged cells to fill in, by row.
+        merged_fills = {}
+
+        # fill merged cells and skip the rows without any content while reading the sheet.
+        title_length = None
+        for j, row in enumerate(sheet_loaded.iter_rows(values_only=True)):
+            line_list = list(row)
+            if merged_cells:
+                for min_col, max_row, max_col in merged_starts.get(j, ()):
+                    line_list.extend([None] * (max_col - len(line_list)))
+                    merged_value = line_list[min_col]
+                    for k in range(j, max_row):
+                        merged_fills.setdefault(k, []).append((min_col, max_col, merged_value))
+                for min_col, max_col, merged_value in merged_fills.pop(j, ()):
+                    line_list.extend([None] * (max_col - len(line_list)))
+                    line_list[min_col:max_col] = [merged_value] * (max_col - min_col)
+            if not any(line_list):
+                continue
+            # rows are not padded when the sheet is unsized, make them at least as long as the title row.
+            if title_length is None:
+                title_length = len(line_list)
+            else:
+                line_list.extend([None] * (title_length - len(line_list)))
+            yield line_list
+    finally:
+        workbook.close()
+
+
+# handlers of the excel columns, called with (pv_temp, row_info, value).
+# row_info collects the values of a row which are not record attributes.
+def _set_row_info(key):
+    def handler(pv_temp, row_info, value):
+        row_info[key] = value
+
+    return handler
+
 
-    for merged_cell in sheet_loaded.merged_cells:
-        merged_value = sheet_loaded.cell(row=merged_cell.min_row, column=merged_cell.min_col).value
-        for i in range(merged_cell.bounds[0] - 1, merged_cell.bounds[2]):
-            for j in range(merged_cell.bounds[1] - 1, merged_cell.bounds[3]):
-                excel_list[j][i] = merged_value
+def _set_record_attr(attr):
+    def handler(pv_temp, row_info, value):
+        setattr(pv_temp, attr, value)
 
-    # for line_list in excel_list:
-    #     for item in line_list:
-    #         print(item, end=' ')
-    #     else:
-    #         print('')
+    return handler
 
-    return excel_list
 
+def _append_other_field(pv_temp, row_info, value):
+    pv_temp.other_fields.append(value)
 
-def get_pv_info(excel_list):
-    pv_title = excel_list[0]
+
+# keywords are matched against the column titles in order, the first match wins.
+TitleHandlers = [
+    ('PLC名称', _set_row_info('device_name')),
+    ('IP:Port', _set_row_info('device_address')),
+    ('Address', _set_record_attr('memory_address')),
+    ('数据操作', _set_record_attr('device_access')),
+    ('数据长度', _set_record_attr('memory_length')),
+    ('PV前缀', _set_record_attr('name_prefix')),
+    ('PV后缀', _set_record_attr('name')),
+    ('更新周期', _set_record_attr('scan')),
+    ('PV描述', _set_record_attr('desc')),
+    ('数据精度', _set_record_attr('prec')),
+    ('数据单位', _set_record_attr('egu')),
+    ('数据类型', _set_record_attr('drvUser_prefix')),
+    ('数据格式', _set_record_attr('drvUser_suffix')),
+    ('掩码', _set_record_attr('memory_address_mask')),
+    ('其他EPICS字段', _append_other_field),
+]
+TitleHandlerMap = dict(TitleHandlers)
+# all keywords in one pattern, used for the titles which are not an exact match.
+TitleKeywordPattern = re.compile('|'.join(re.escape(keyword) for keyword, _ in TitleHandlers))
+TitleKeywordOrder = {keyword: i for i, (keyword, _) in enumerate(TitleHandlers)}
+
+
+# excel_rows is an iterable of rows, the first one holds the column titles.
+def get_pv_info(excel_rows):
+    excel_rows = iter(excel_rows)
+    pv_title = next(excel_rows, None)
+    if pv_title is None:
+        return []
+    # resolve the handler of each column once, instead of matching the titles for every row.
+    # titles are looked up by their first line, e.g. "Address\n(十进制或十六进制)" -> "Address",
+    # other titles fall back to keyword matching.
+    col_handlers = []
+    for title in pv_title:
+        if not title:
+            col_handlers.append(None)
+            continue
+        handler = TitleHandlerMap.get(title.split('\n', 1)[0].strip())
+        if not handler:
+            keywords = TitleKeywordPattern.findall(title)
+            if keywords:
+                handler = TitleHandlerMap[min(keywords, key=TitleKeywordOrder.get)]
+        col_handlers.append(handler)
     pv_list = []
-    for j in range(1, len(excel_list)):
+    for line_list in excel_rows:
         pv_temp = ModbusRecord(record_name=None, record_type=None)
         #
-        device_name = None
-        device_address = None
-        #
-        for i in range(len(pv_title)):
-            if 'PLC名称' in pv_title[i]:
-                device_name = excel_list[j][i]
-            elif 'IP:Port' in pv_title[i]:
-                device_address = excel_list[j][i]
-            elif 'Address' in pv_title[i]:
-                pv_temp.memory_address = excel_list[j][i]
-            elif '数据操作' in pv_title[i]:
-                pv_temp.device_access = excel_list[j][i]
-            elif '数据长度' in pv_title[i]:
-                pv_temp.memory_length = excel_list[j][i]
-            elif 'PV前缀' in pv_title[i]:
-                pv_temp.name_prefix = excel_list[j][i]
-            elif 'PV后缀' in pv_title[i]:
-                pv_temp.name = excel_list[j][i]
-            elif '更新周期' in pv_title[i]:
-                pv_temp.scan = excel_list[j][i]
-            elif 'PV描述' in pv_title[i]:
-                pv_temp.desc = excel_list[j][i]
-            elif '数据精度' in pv_title[i]:
-                pv_temp.prec = excel_list[j][i]
-            elif '数据单位' in pv_title[i]:
-                pv_temp.egu = excel_list[j][i]
-            elif '数据类型' in pv_title[i]:
-                pv_temp.drvUser_prefix = excel_list[j][i]
-            elif '数据格式' in pv_title[i]:
-                pv_temp.drvUser_suffix = excel_list[j][i]
-            elif '掩码' in pv_title[i]:
-                pv_temp.memory_address_mask = excel_list[j][i]
-            elif '其他EPICS字段' in pv_title[i]:
-                pv_temp.other_fields.append(excel_list[j][i])
+        row_info = {'device_name': None, 'device_address': None}
+        for i, handler in enumerate(col_handlers):
+            if handler:
+                handler(pv_temp, row_info, line_list[i])
+        device_name = row_info['device_name']
+        device_address = row_info['device_address']
         #
-        if device_name and device_name not in DeviceRegistered.keys():
-            DeviceRegistered[device_name] = ModbusDevice()
-            DeviceRegistered[device_name].name = device_name
-            DeviceRegistered[device_name].address = device_address
-            DeviceRegistered[device_name].device_type = 'Modbus'
         if device_name:
-            pv_temp.device = DeviceRegistered[device_name]
+            device = DeviceRegistered.get(device_name)
+            if device is None:
+                device = ModbusDevice()
+                device.name = device_name
+                device.address = device_address
+                device.device_type = 'Modbus'
+                DeviceRegistered[device_name] = device
+            pv_temp.device = device
         #
         if pv_temp.device_access == 'rw':
-            pv_temp_r = copy.deepcopy(pv_temp)
+            pv_temp_r = pv_temp.clone()
+            pv_temp_w = pv_temp.clone()
             pv_temp_r.device_access = 'r'
-            pv_temp_r.name += 'R'
-            pv_temp_w = copy.deepcopy(pv_temp)
             pv_temp_w.device_access = 'w'
-            pv_temp_w.name += 'W'
+            # records without a PV name are reported by gen_check.
+            if isinstance(pv_temp.name, str):
+                pv_temp_r.name += 'R'
+                pv_temp_w.name += 'W'
             pv_list.append(pv_temp_r)
             pv_list.append(pv_temp_w)
         else:
@@ -268,14 +390,13 @@ if __name__ == '__main__':
     else:
         if not os.path.isfile(sys.argv[1]):
             print(f'{sys.argv[0]}: Invalid excel path: {sys.argv[1]}!')
-            exit(1)
+            sys.exit(1)
         file_name = ''
         pl = None
         if len(sys.argv) == 2:
             if os.path.isfile(sys.argv[1]):
                 pl = get_pv_info(get_excel_cells(file_path=sys.argv[1]))
-                for key in DeviceRegistered.keys():
-                    file_name += key
+                file_name = ''.join(DeviceRegistered)
                 # for item in pl:
                 #     print(item)
                 # else:
@@ -296,20 +417,43 @@ if __name__ == '__main__':
         object_db_file = os.path.join(object_path, f'{file_name}.db')
         object_cmd_file = os.path.join(object_path, f'{file_name}.txt')
         #
-        lines_for_db = []
-        lines_for_cmd = []
-        for device_item in DeviceRegistered.values():
-            lines_for_cmd.append(f'drvAsynIPPortConfigure("{device_item.name}", "{device_item.address}", 0, 0, 1)\n')
-            lines_for_cmd.append(f'modbusInterposeConfig("{device_item.name}", 0, 2000, 0)\n')
-        else:
-            lines_for_cmd.append('\n')
-        for pv_item in pl:
-            pv_item.gen_prepare()
-            lines_for_db.extend(pv_item.gen_db_lines())
-            lines_for_cmd.extend(pv_item.gen_config_lines())
-        else:
-            with open(object_db_file, 'w') as f:
-                f.writelines(lines_for_db)
-            with open(object_cmd_file, 'w') as f:
-                f.writelines(lines_for_cmd)
+        try:
+            # prepare and check all records first, a bad row should not leave output files behind.
+            for pv_item in pl:
+                pv_item.gen_prepare()
+            # write to uniquely named temporary files next to the outputs, so a failed or concurrent run
+            # does not leave half-written outputs. each output is replaced only once both files are complete,
+            # but the two replaces are separate: if the second one fails, the new .db sits next to the old .txt.
+            temp_files = []
+            try:
+                umask = os.umask(0)
+                os.umask(umask)
+                for suffix in ('.db.tmp', '.txt.tmp'):
+                    with tempfile.NamedTemporaryFile(dir=object_path, prefix=f'{file_name}.', suffix=suffix,
+                                                     delete=False) as f:
+                        temp_files.append(f.name)
+                    # temporary files are private, give the outputs the usual permissions.
+                    os.chmod(f.name, 0o666 & ~umask)
+                object_db_temp, object_cmd_temp = temp_files
+                # records are written one by one, a large buffer keeps the number of write calls low.
+                with open(object_db_temp, 'w', buffering=1 << 20) as f_db, \
+                        open(object_cmd_temp, 'w', buffering=1 << 20) as f_cmd:
+                    for device_item in DeviceRegistered.values():
+                        f_cmd.write(f'drvAsynIPPortConfigure("{device_item.name}", "{device_item.address}", 0, 0, 1)\n')
+                        f_cmd.write(f'modbusInterposeConfig("{device_item.name}", 0, 2000, 0)\n')
+                    f_cmd.write('\n')
+                    # write each record as it is generated instead of holding the whole output in memory.
+                    for pv_item in pl:
+                        f_db.write(''.join(pv_item.gen_db_lines()))
+                        f_cmd.write(pv_item.gen_config_lines())
+                os.replace(object_db_temp, object_db_file)
+                os.replace(object_cmd_temp, object_cmd_file)
+            finally:
+                # nothing is left after the replaces, otherwise drop the partial files.
+                for temp_file in temp_files:
+                    if os.path.isfile(temp_file):
+                        os.remove(temp_file)
             print(DeviceRegistered)
+        except ConfigError as e:
+            print(f'{sys.argv[0]}: {e}')
+            sys.exit(1)
@@ -38,6 +38,16 @@ pvdb = {
 class myDriver(Driver):
     def __init__(self):
         Driver.__init__(self)
+        # buffers reused by every waveform update
+        self.index = numpy.arange(MAX_POINTS, dtype=float)
+        self.timeWave = numpy.empty(MAX_POINTS)
+        self.noise = numpy.empty(MAX_POINTS)
+        self.data = numpy.empty(MAX_POINTS)
+        self.rng = numpy.random.default_rng()
+        # settings used by the simulation, kept up to date by write() so the loop does not query them
+        self.settings = {reason: pvdb[reason].get('value', 0) for reason in
+                         ('Run', 'UpdateTime', 'NoiseAmplitude', 'TimePerDivision', 'VoltsPerDivision',
+                          'TriggerDelay', 'VoltOffset')}
         self.eid = threading.Event()
         self.tid = threading.Thread(target=self.runSimScope)
         self.tid.setDaemon(True)
@@ -49,44 +59,58 @@ class myDriver(Driver):
         if reason == 'UpdateTime':
             value = max(MIN_UPDATE_TIME, value)
         elif reason == 'Run':
-            if not self.getParam('Run') and value == 1:
+            if not self.settings['Run'] and value == 1:
                 self.eid.set()
                 self.eid.clear()
         # store the values
         if status:
+            if reason in self.settings:
+                self.settings[reason] = value
             self.setParam(reason, value)
         return status
 
     def runSimScope(self):
         # simulate scope waveform
+        # constants of the loop
+        angularFrequency = FREQUENCY * 2 * numpy.pi
+        yCenter = NUM_DIVISIONS / 2.0
+        settings = self.settings
         while True:
-            run = self.getParam('Run')
-            updateTime = self.getParam('UpdateTime')
+            run = settings['Run']
+            updateTime = settings['UpdateTime']
             if run:
                 self.eid.wait(updateTime)
             else:
                 self.eid.wait()
-            run = self.getParam('Run')
+            run = settings['Run']
             if not run: continue
             # retrieve parameters
-            noiseAmplitude = self.getParam('NoiseAmplitude')
-            timePerDivision = self.getParam('TimePerDivision')
-            voltsPerDivision = self.getParam('VoltsPerDivision')
-            triggerDelay = self.getParam('TriggerDelay')
-            voltOffset = self.getParam('VoltOffset')
-            # calculate the data wave based on timeWave scale
+            noiseAmplitude = settings['NoiseAmplitude']
+            timePerDivision = settings['TimePerDivision']
+            voltsPerDivision = settings['VoltsPerDivision']
+            triggerDelay = settings['TriggerDelay']
+            voltOffset = settings['VoltOffset']
+            # calculate the data wave based on timeWave scale, in place to avoid temporary arrays
             timeStart = triggerDelay
             timeStep = timePerDivision * NUM_DIVISIONS / MAX_POINTS
-            timeWave = timeStart + numpy.arange(MAX_POINTS) * timeStep
-            noise = noiseAmplitude * numpy.random.random(MAX_POINTS)
-            data = AMPLITUDE * numpy.sin(timeWave * FREQUENCY * 2 * numpy.pi) + noise
+            timeWave = numpy.multiply(self.index, timeStep, out=self.timeWave)
+            timeWave += timeStart
+            noise = self.rng.random(out=self.noise)
+            noise *= noiseAmplitude
+            data = numpy.multiply(timeWave, angularFrequency, out=self.data)
+            numpy.sin(data, out=data)
+            data *= AMPLITUDE
+            data += noise
             # calculate statistics
             self.setParam('MinValue', data.min())
             self.setParam('MaxValue', data.max())
-            self.setParam('MeanValue', data.mean())
+            self.setParam('MeanValue', data.sum() / MAX_POINTS)
             # scale/offset
             yScale = 1.0 / voltsPerDivision
-            data = NUM_DIVISIONS / 2.0 + yScale * (data + voltOffset)
+            data += voltOffset
+            data *= yScale
+            data += yCenter
+            # setParam keeps a copy of the array, so the buffer can be reused next time
             self.setParam('Waveform', data)
             # do updates so clients see the changes
             self.updatePVs()